@@ -127,11 +127,14 @@ def parse_args():
         type=str, help='the destination output file')
     parser.add_argument(
         '-a', '--all-touched', dest='all_touched', action='store_true')
+    parser.add_argument(
+        '--zarr-cache', dest='zarr_cache', type=str, action='store',
+        help='a directory to cache the netcdf values in as zarr stores')
     parser.set_defaults(
         stats='min,max,mean,median,majority,sum,std,count,range',
         output_dir=os.getcwd(), output_format='csv',
         output_file='zonal_stats', all_touched=False, report_geometry=False,
-        nc_file=None, raster=None)
+        nc_file=None, raster=None, zarr_cache=None)
     return parser.parse_args()
 # 1}}} -----------------------------------------------------------------------
 
@@ -161,6 +164,9 @@ if __name__ == "__main__":
             output_file=args.output_file,
             all_touched=args.all_touched,
             output_format=args.output_format,
-            geometry=args.report_geometry)
+            geometry=args.report_geometry,
+            zarr_cache=args.zarr_cache,
+            stream=True)
         c.chop()
         c.export()
+        c.close()
@@ -21,9 +21,18 @@ import csv
 from pathlib import Path
 import pandas as pd
 import patoolib as pa
+import numpy as np
+import rasterio
 import geopandas as gpd
 from tempfile import TemporaryDirectory
-from rasterstats import zonal_stats
+from rasterio.windows import Window
+try:
+    from choppyzs.zonal import (check_statistics, crop_zones,
+                                rasterize_zones, read_geometries,
+                                zonal_statistics)
+except ImportError:
+    from .zonal import (check_statistics, crop_zones, rasterize_zones,
+                        read_geometries, zonal_statistics)
 
 
 # 1}}} ------------------------------------------------------------------------
@@ -57,10 +66,7 @@ class Choppy:
             raise RuntimeError(f'This format ({output_format}) is not '
                                f'acceptable!')
         self.working_directory = TemporaryDirectory()
-        if ',' in statistics:
-            self.statistics = statistics.split(',')
-        if ',' not in statistics:
-            self.statistics = statistics
+        self.statistics = check_statistics(statistics)
         self.output_format = output_format
         if not output_file.lower().endswith(output_format):
             self.output_file = output_file + '.' + output_format
@@ -95,7 +101,8 @@ class Choppy:
         else:
             self.geojson = False
         self.all_touched = all_touched
-        self.shapes = gpd.read_file(self.shape_file)
+        self.shapes = gpd.read_file(self.shape_file,
+                                    ignore_geometry=geometry is False)
 
     def __str__(self):
         """ Display information about a Choppy object """
@@ -108,16 +115,32 @@ class Choppy:
                'all touched:\t\t' + str(self.all_touched) + '\n\t'
 
     def chop(self):
-        stats_data = zonal_stats(self.shape_file,
-                                 self.raster_file, geojson_out=self.geojson,
-                                 all_touched=self.all_touched,
-                                 stats=self.statistics)
-        sd = pd.DataFrame.from_dict(stats_data)
+        """ Compute the zonal statistics of the raster's first band """
+        stats_data = {}
+        with rasterio.open(self.raster_file) as raster:
+            nodata = raster.nodata if raster.nodata is not None else -999
+            if self.geometry is False:
+                geometries = read_geometries(self.shape_file)
+            else:
+                geometries = self.shapes.geometry
+            # like rasterstats, only the window of one shape is held at once
+            for i, geometry in enumerate(geometries):
+                zone = rasterize_zones([geometry], raster.transform,
+                                       raster.shape,
+                                       all_touched=self.all_touched)
+                (rows, cols), zone = crop_zones(zone, raster.shape)
+                values = raster.read(1, window=Window.from_slices(rows, cols))
+                for name, value in zonal_statistics(
+                        values, zone, self.statistics, nodata=nodata,
+                        dtype=np.float64).items():
+                    if name not in stats_data:
+                        stats_data[name] = np.empty(len(geometries),
+                                                    dtype=value.dtype)
+                    stats_data[name][i] = value[0]
         df = pd.DataFrame(self.shapes)
-        if self.geometry is False:
-            dat = pd.concat([df, sd], axis=1).drop(columns='geometry')
-        elif self.geometry is not False:
-            dat = pd.concat([df, sd], axis=1)
+        columns = {name: df[name].values for name in df.columns}
+        columns.update(stats_data)
+        dat = pd.DataFrame(columns, copy=False)
         if self.melt is True:
             df = pd.melt(df, value_vars=self.statistics, var_name='Attribute')
         if self.output_format == 'csv':
@@ -2,24 +2,32 @@
 # -*- coding: utf-8 -*-
 """Compute zonal statistics of a netcdf."""
 import os
+import hashlib
 import logging
+import queue
+import threading
+import numpy as np
 from tempfile import TemporaryDirectory
 import pandas as pd
 import xarray as xr
 import rioxarray
-import re
+import netCDF4
+import numcodecs
+import zarr
 import sys
 import patoolib as pa
-import rasterio as rio
 import geopandas as gpd
-from datetime import datetime
-from rasterstats import zonal_stats
 try:
     from choppyzs.imagediff import check_if_file_exists
     from choppyzs.logz import create_logger
+    from choppyzs.zonal import (check_statistics, crop_zones,
+                                rasterize_zones, read_geometries,
+                                zonal_statistics)
 except ImportError:
     from .imagediff import check_if_file_exists
     from .logz import create_logger
+    from .zonal import (check_statistics, crop_zones, rasterize_zones,
+                        read_geometries, zonal_statistics)
 
 logger = create_logger()
 
@@ -30,19 +38,27 @@ class NetCDF2Stats():
     def __init__(self, shape_archive, nc_file, output_dir=os.getcwd(),
                  statistics='min,max,mean,median,majority,sum,std,count,range',
                  output_file='zonal_stats', all_touched=False,
-                 output_format='csv', geometry=False):
+                 output_format='csv', geometry=False, zarr_cache=None,
+                 stream=False):
         """Initialize the NetCDF2Stats class."""
         if output_format not in ['xlsx', 'csv', 'tsv', 'none', None]:
             raise RuntimeError(f'Format {output_format} is not acceptable!')
         self.output_format = output_format
         self.working_directory = TemporaryDirectory()
-        if ',' in statistics:
-            self.statistics = statistics.split(',')
-        else:
-            self.statistics = statistics
+        self.statistics = check_statistics(statistics)
         self.all_touched = all_touched
         self.shape_archive = shape_archive
         self.nc_file = nc_file
+        # the file the values are read from, a rechunked copy if needed
+        self.read_file = nc_file
+        # rechunked copies of the variables needing one, by variable
+        self.rechunked = {}
+        self.nc_reader = None
+        # a directory keeping the values as zarr stores between runs
+        self.zarr_cache = zarr_cache
+        # whether chop writes csv and tsv rows instead of keeping them
+        self.stream = stream
+        self.output_stream = None
         self.output_file = output_file + '.' + output_format
         self.geometry = geometry
         pa.extract_archive(shape_archive, outdir=self.working_directory.name)
@@ -57,51 +73,341 @@ class NetCDF2Stats():
             self.geojson = True
         else:
             self.geojson = False
-        self.shape_df = gpd.read_file(self.shape_file)
+        self.shape_df = gpd.read_file(self.shape_file,
+                                      ignore_geometry=geometry is False)
         self.nc_ds = xr.open_dataset(self.nc_file, engine="rasterio")
         self.nc_ds = self.nc_ds.rio.write_crs("epsg:4326", inplace=True)
-        #self.affine = rio.open(self.nc_file).transform
-        self.df_list = []
+        # the grid is the same for every time so it is only looked up once
+        self.affine = self.nc_ds.rio.transform()
+        self.grid_shape = (self.nc_ds.rio.height, self.nc_ds.rio.width)
+        if geometry is False:
+            geometries = read_geometries(self.shape_file)
+        else:
+            geometries = self.shape_df.geometry
+        self.zones = rasterize_zones(geometries, self.affine,
+                                     self.grid_shape,
+                                     all_touched=self.all_touched)
+        # only the window of the grid covered by the zones is ever read
+        self.window, self.zones = crop_zones(self.zones, self.grid_shape)
+        self.window_shape = tuple(w.stop - w.start for w in self.window)
+        # attributes are kept column by column
+        self.shape_columns = {name: self.shape_df[name].values
+                              for name in self.shape_df.columns}
+        self.stat_columns = []
+
+    def _rechunk(self, value_var, time_var='time'):
+        """Copy value_var into a netcdf chunked one time slice per chunk."""
+        if value_var in self.rechunked:
+            self.read_file = self.rechunked[value_var]
+            return
+        self.read_file = self.nc_file
+        with netCDF4.Dataset(self.nc_file) as src:
+            if value_var not in src.variables:
+                return
+            src_var = src[value_var]
+            chunking = src_var.chunking()
+            if not isinstance(chunking, list) or \
+                    time_var not in src_var.dimensions:
+                return
+            time_axis = src_var.dimensions.index(time_var)
+            spatial = [c < n for i, (c, n) in enumerate(
+                zip(chunking, src_var.shape)) if i != time_axis]
+            if chunking[time_axis] <= 1 or not any(spatial):
+                return
+            logger.info(f'Rechunking {value_var} from {chunking}')
+            rechunked = os.path.join(self.working_directory.name,
+                                     f'rechunked.{value_var}.nc')
+            try:
+                with netCDF4.Dataset(rechunked, 'w', format='NETCDF4') as dst:
+                    dst.setncatts(src.__dict__)
+                    for name, dim in src.dimensions.items():
+                        dst.createDimension(
+                            name, None if dim.isunlimited() else len(dim))
+                    for name, var in src.variables.items():
+                        # leave out the other grids, only value_var is read
+                        if name != value_var and var.ndim > 2:
+                            continue
+                        var.set_auto_maskandscale(False)
+                        attrs = {k: var.getncattr(k) for k in var.ncattrs()}
+                        fill_value = attrs.pop('_FillValue', None)
+                        if name == value_var:
+                            chunksizes = [1 if d == time_var else n for d, n
+                                          in zip(var.dimensions, var.shape)]
+                        else:
+                            chunksizes = None
+                        out = dst.createVariable(name, var.datatype,
+                                                 var.dimensions,
+                                                 fill_value=fill_value,
+                                                 chunksizes=chunksizes)
+                        out.setncatts(attrs)
+                        out.set_auto_maskandscale(False)
+                        if name != value_var:
+                            out[...] = var[...]
+                    # copy along the grid so every source chunk is read once
+                    out = dst[value_var]
+                    axis = [i for i in range(src_var.ndim)
+                            if i != time_axis][0]
+                    step = chunking[axis] * max(1, (256 * 1024 * 1024) // (
+                        src_var.dtype.itemsize * src_var.size //
+                        src_var.shape[axis] * chunking[axis]))
+                    for start in range(0, src_var.shape[axis], step):
+                        index = [slice(None)] * src_var.ndim
+                        index[axis] = slice(start, start + step)
+                        out[tuple(index)] = src_var[tuple(index)]
+            except (OSError, RuntimeError, ValueError) as err:
+                logger.warning(f'Could not rechunk {self.nc_file}: {err}')
+                if os.path.exists(rechunked):
+                    os.remove(rechunked)
+                return
+        self.rechunked[value_var] = rechunked
+        self.read_file = rechunked
+
+    def _reader(self, value_var, time_var, window):
+        """Return a function reading the window of value_var by position."""
+        read = self._native_reader(value_var, window)
+        if read is None:
+            nc_var = self.nc_ds[value_var]
+
+            def read(positions):
+                return nc_var.isel({time_var: positions,
+                                    nc_var.rio.y_dim: window[0],
+                                    nc_var.rio.x_dim: window[1]}).values
+        return read
+
+    def _zarr_reader(self, value_var, time_var, batch_size):
+        """Return a function reading the window of value_var from zarr."""
+        os.makedirs(self.zarr_cache, exist_ok=True)
+        source_path = os.path.abspath(self.nc_file)
+        store_path = os.path.join(
+            self.zarr_cache, f'{os.path.basename(self.nc_file)}.'
+            f'{hashlib.md5(source_path.encode()).hexdigest()[:8]}.'
+            f'{value_var}.zarr')
+        source = {'source': source_path,
+                  'variable': value_var,
+                  'size': os.path.getsize(self.nc_file),
+                  'mtime': os.path.getmtime(self.nc_file)}
+        n_times = self.nc_ds.sizes[time_var]
+        shape = (n_times,) + self.grid_shape
+        try:
+            store = zarr.open_array(store_path, mode='r')
+            cached = store.shape == shape and \
+                all(store.attrs.get(k) == v for k, v in source.items())
+        except (ValueError, KeyError, zarr.errors.ArrayNotFoundError):
+            cached = False
+        if not cached:
+            logger.info(f'Caching {value_var} into {store_path}')
+            self._rechunk(value_var, time_var)
+            store = zarr.open_array(
+                store_path, mode='w', shape=shape,
+                chunks=(1,) + self.grid_shape, dtype='f4',
+                fill_value=np.nan,
+                compressor=numcodecs.Blosc(cname='zstd', clevel=3,
+                                           shuffle=numcodecs.Blosc.BITSHUFFLE))
+            grid = (slice(0, self.grid_shape[0]), slice(0, self.grid_shape[1]))
+            for start, times, values in self._read_batches(
+                    self._reader(value_var, time_var, grid),
+                    np.arange(n_times), np.arange(n_times), batch_size):
+                store[start:start + len(times)] = values
+            # written last so an interrupted cache is never reused
+            store.attrs.update(source)
+        rows, cols = self.window
+
+        def read(positions):
+            if positions[-1] - positions[0] + 1 == len(positions):
+                return store[positions[0]:positions[-1] + 1, rows, cols]
+            return store.get_orthogonal_selection((positions, rows, cols))
+        return read
+
+    def _native_reader(self, value_var, window):
+        """Return a netCDF4 reader of value_var by time position, or None."""
+        if self.nc_reader is not None:
+            self.nc_reader.close()
+        self.nc_reader = netCDF4.Dataset(self.read_file)
+        var = self.nc_reader[value_var]
+        if var.ndim != 3 or tuple(var.shape[1:]) != self.grid_shape:
+            return None
+        var.set_auto_maskandscale(False)
+        var.set_var_chunk_cache(size=256 * 1024 * 1024, nelems=4133,
+                                preemption=0.75)
+        rows, cols = window
+        attrs = {k: var.getncattr(k) for k in var.ncattrs()}
+        fill_values = [attrs[k] for k in ('_FillValue', 'missing_value')
+                       if k in attrs]
+        # GDAL serves the grid north up, flip files stored south up
+        y_var = var.dimensions[1]
+        flip = False
+        if y_var in self.nc_reader.variables and self.grid_shape[0] > 1:
+            file_y = self.nc_reader[y_var][[0, -1]]
+            grid_y = self.nc_ds.y.values[[0, -1]]
+            flip = (file_y[0] < file_y[1]) != (grid_y[0] < grid_y[1])
+        if flip:
+            rows = slice(self.grid_shape[0] - rows.stop,
+                         self.grid_shape[0] - rows.start)
+
+        def read(positions):
+            if positions[-1] - positions[0] + 1 == len(positions):
+                raw = var[positions[0]:positions[-1] + 1, rows, cols]
+            else:
+                raw = var[positions, rows, cols]
+            values = raw.astype(np.float32)
+            for fill_value in fill_values:
+                values[raw == fill_value] = np.nan
+            if 'scale_factor' in attrs:
+                values *= np.float32(attrs['scale_factor'])
+            if 'add_offset' in attrs:
+                values += np.float32(attrs['add_offset'])
+            if flip:
+                values = values[:, ::-1]
+            return values
+        return read
+
+    def _read_batches(self, read, nc_times, positions, batch_size):
+        """Yield (start, times, values) batches read one batch ahead."""
+        batches = queue.Queue(maxsize=1)
+        stop = threading.Event()
 
-    def chop(self, time_var='time', start_year=None, time_range=None, value_var='scpdsi'):
-        """Chop the raster stats over the years."""
+        def produce():
+            try:
+                for start in range(0, len(nc_times), batch_size):
+                    if stop.is_set():
+                        return
+                    batch_times = nc_times[start:start + batch_size]
+                    nc_arr_values = read(
+                        positions[start:start + batch_size]).astype(
+                        np.float32, copy=False)
+                    nc_arr_values = nc_arr_values.reshape(
+                        (len(batch_times),) + nc_arr_values.shape[-2:])
+                    batches.put((start, batch_times, nc_arr_values))
+            except Exception as err:
+                batches.put(err)
+                return
+            batches.put(None)
+
+        reader = threading.Thread(target=produce, daemon=True)
+        reader.start()
+        try:
+            while True:
+                batch = batches.get()
+                if batch is None:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            # unblock the reader if the batches were not all consumed
+            stop.set()
+            while reader.is_alive():
+                try:
+                    batches.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+    def chop(self, time_var='time', start_year=None, time_range=None, value_var='scpdsi',
+             batch_size=32):
+        """Chop the raster stats over the years, batch_size times at once."""
         nc_var = self.nc_ds[value_var]
         logger.info(f'nc_var length: {value_var}:{len(nc_var)}')
         org_nc_times = self.nc_ds[time_var].values
+        positions = np.arange(len(org_nc_times))
         if start_year:
-            nc_times = [d for d in org_nc_times if datetime.fromisoformat(re.sub('T.*$', '', str(d))) >=  datetime.fromisoformat(f'{start_year}-01-01')]        
+            # .dt works for both datetime64 and the cftime rasterio decodes
+            years = self.nc_ds[time_var].dt.year.values
+            positions = positions[years >= int(start_year)]
         elif time_range: # e.go. 11-12
             start_index, end_index = time_range.split('-')
-            nc_times = org_nc_times[int(start_index):int(end_index)] # select noon
-        else:
-            nc_times = org_nc_times
+            positions = positions[int(start_index):int(end_index)] # select noon
+        nc_times = org_nc_times[positions]
         logger.info(f'Parsing {nc_times} out of {len(org_nc_times)} times')
-        
-        for nc_time in nc_times:
-            logger.info(f'Parsing time {nc_time}')
-            nc_arr = nc_var.sel(time=nc_time)
-            logger.info(f'nc_arr length:{len(nc_arr)}')
-
-            nc_arr_values = nc_arr.squeeze().values
-
-            stats_data = zonal_stats(self.shape_file,
-                                     nc_arr_values, affine=nc_arr.rio.transform(),
-                                     stats=self.statistics,
-                                     nodata=-999,
-                                     geojson_out=self.geojson,
-                                     all_touched=self.all_touched)
-            sd = pd.DataFrame.from_dict(stats_data)
-            df = pd.DataFrame(self.shape_df)
-            dat = pd.concat([df, sd], axis=1)
-            logging.info(f'{nc_time}')
-            dat['time'] = nc_time
-            if self.geometry is False:
-                dat.drop(columns='geometry', inplace=True, errors='ignore')
-            self.df_list.append(dat)
+
+        # streamed csv and tsv rows are written as they come, otherwise the
+        # rows fill one preallocated column per statistic
+        stream = self.stream and self.output_format in ['csv', 'tsv']
+        n_zones = len(self.shape_df)
+        n_times = len(nc_times)
+        columns = {}
+        if self.zarr_cache:
+            read = self._zarr_reader(value_var, time_var, batch_size)
+        else:
+            self._rechunk(value_var, time_var)
+            read = self._reader(value_var, time_var, self.window)
+        for start, batch_times, nc_arr_values in self._read_batches(
+                read, nc_times, positions, batch_size):
+            logger.info(f'Parsing times {batch_times[0]} to {batch_times[-1]}')
+            stats_data = zonal_statistics(nc_arr_values, self.zones,
+                                          self.statistics, nodata=-999)
+            logging.info(f'{batch_times[0]} to {batch_times[-1]}')
+            if stream:
+                stats_data = {k: v.ravel() for k, v in stats_data.items()}
+                stats_data['time'] = np.repeat(np.asarray(batch_times),
+                                               n_zones)
+                self._write_rows(self._frame(stats_data))
+                continue
+            rows = slice(start * n_zones,
+                         (start + len(batch_times)) * n_zones)
+            for name, values in stats_data.items():
+                if name not in columns:
+                    columns[name] = np.empty(n_zones * n_times,
+                                             dtype=values.dtype)
+                columns[name][rows] = values.ravel()
+        if not n_times:
+            # nothing is selected, the output still gets every column
+            stats_data = zonal_statistics(
+                np.empty((0,) + self.window_shape, dtype=np.float32),
+                self.zones, self.statistics, nodata=-999)
+            columns = {k: v.ravel() for k, v in stats_data.items()}
+        if stream and not n_times:
+            columns['time'] = np.asarray(nc_times)
+            self._write_rows(self._frame(columns))
+        elif not stream:
+            columns['time'] = np.repeat(np.asarray(nc_times), n_zones)
+            self.stat_columns.append(columns)
+
+    def _frame(self, stat_columns):
+        """Return the shape attributes repeated alongside stat_columns."""
+        # the shapes repeat once per time, in the same order as the stats
+        n_zones = len(self.shape_df)
+        rows = np.tile(np.arange(n_zones),
+                       len(stat_columns['time']) // max(n_zones, 1))
+        columns = {name: values.take(rows)
+                   for name, values in self.shape_columns.items()}
+        columns.update(stat_columns)
+        # the columns are used as they are instead of being copied into
+        # consolidated blocks, which would double the memory at this point
+        return pd.DataFrame(columns, copy=False)
+
+    def _write_rows(self, df):
+        """Append the rows of df to the csv or tsv output file."""
+        header = self.output_stream is None
+        if header:
+            self.output_stream = open(self.output_path, 'w', newline='')
+        df.to_csv(self.output_stream, sep='\t' if self.output_format == 'tsv'
+                  else ',', index=False, header=header)
+
+    def close(self):
+        """Close the netcdf handles and remove the working directory."""
+        if self.output_stream is not None:
+            self.output_stream.close()
+            self.output_stream = None
+        if self.nc_reader is not None:
+            self.nc_reader.close()
+            self.nc_reader = None
+        self.nc_ds.close()
+        self.working_directory.cleanup()
 
     def export(self):
-        """Export the dataframe as the appropriate output."""
-        self.df = pd.concat(self.df_list, ignore_index=True)
+        """Export the dataframe, returning None when rows were streamed."""
+        if self.output_stream is not None:
+            self.output_stream.close()
+            self.output_stream = None
+            self.df = None
+            return self.df
+        if len(self.stat_columns) == 1:
+            stat_columns = self.stat_columns[0]
+        else:
+            stat_columns = {name: np.concatenate([c[name] for c in
+                                                  self.stat_columns])
+                            for name in self.stat_columns[0]}
+        self.df = self._frame(stat_columns)
         if self.output_format == 'csv':
             self.df.to_csv(self.output_path, index=False)
         elif self.output_format == 'tsv':
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Compute zonal statistics against zones rasterized once onto a grid."""
+import math
+from collections import namedtuple
+from functools import lru_cache
+import fiona
+import numpy as np
+from affine import Affine
+from numba import njit, prange
+from rasterio import features
+
+# statistics are reported in the same order rasterstats uses
+STATS_ORDER = ['min', 'max', 'mean', 'count', 'sum', 'std', 'median',
+               'majority', 'minority', 'unique', 'range']
+VALID_STATS = STATS_ORDER + ['nodata', 'nan']
+
+Zones = namedtuple('Zones', ['cells', 'offsets', 'outside'])
+
+
+def check_statistics(stats):
+    """Return stats as a list, raising ValueError for unknown statistics.
+
+    Accepts the same statistics as rasterstats, percentile_q included, given
+    either as a list or a string separated by commas or spaces.
+    """
+    if not stats:
+        return ['count', 'min', 'max', 'mean']
+    if isinstance(stats, str):
+        if stats in ['*', 'ALL']:
+            return list(VALID_STATS)
+        stats = stats.replace(',', ' ').split()
+    for stat in stats:
+        if stat.startswith('percentile_'):
+            get_percentile(stat)
+        elif stat not in VALID_STATS:
+            raise ValueError(f'Statistic {stat} is not one of {VALID_STATS}!')
+    return list(stats)
+
+
+def get_percentile(stat):
+    """Return q of a percentile_q statistic."""
+    q = float(stat[len('percentile_'):])
+    if not 0.0 <= q <= 100.0:
+        raise ValueError(f'Percentile {q} is not between 0 and 100!')
+    return q
+
+
+def bounds_window(bounds, affine):
+    """Return the (row, col) ranges of the grid window covering bounds."""
+    west, south, east, north = bounds
+    row_start = math.floor((north - affine.f) / affine.e)
+    col_start = math.floor((west - affine.c) / affine.a)
+    row_stop = math.ceil((south - affine.f) / affine.e)
+    col_stop = math.ceil((east - affine.c) / affine.a)
+    return (row_start, row_stop), (col_start, col_stop)
+
+
+def read_geometries(shape_file):
+    """Return the geometries of shape_file as GeoJSON-like mappings.
+
+    Going through fiona skips building shapely geometries, which is most of
+    the cost of geopandas.read_file when only the zones are needed.
+    """
+    with fiona.open(shape_file) as shapes:
+        return [feature['geometry'] for feature in shapes]
+
+
+def rasterize_zones(geometries, affine, shape, all_touched=False):
+    """Rasterize every geometry once and keep the grid cells it covers.
+
+    Each geometry is burned into the window of the grid covering its bounds,
+    just like rasterstats does per call, so geometries sharing cells (e.g.
+    neighbours with all_touched) each keep them. The flat indices of the cells
+    of every zone are stored back to back in cells, zone i spanning
+    cells[offsets[i]:offsets[i + 1]]; outside counts the cells of each zone
+    falling off the grid. geometries are shapely geometries or GeoJSON-like
+    mappings.
+    """
+    n_rows, n_cols = shape
+    cells = []
+    outside = np.zeros(len(geometries), dtype=np.int64)
+    for i, geom in enumerate(geometries):
+        if geom is None or getattr(geom, 'is_empty', False):
+            cells.append(np.empty(0, dtype=np.int64))
+            continue
+        (row_start, row_stop), (col_start, col_stop) = bounds_window(
+            features.bounds(geom), affine)
+        window_shape = (row_stop - row_start, col_stop - col_start)
+        if min(window_shape) <= 0:
+            cells.append(np.empty(0, dtype=np.int64))
+            continue
+        burned = features.rasterize(
+            [(geom, 1)], out_shape=window_shape,
+            transform=affine * Affine.translation(col_start, row_start),
+            fill=0, dtype='uint8', all_touched=all_touched)
+        rows, cols = np.nonzero(burned)
+        rows = rows.astype(np.int64) + row_start
+        cols = cols.astype(np.int64) + col_start
+        on_grid = (rows >= 0) & (rows < n_rows) & (cols >= 0) & (cols < n_cols)
+        outside[i] = np.count_nonzero(~on_grid)
+        cells.append(rows[on_grid] * n_cols + cols[on_grid])
+    offsets = np.zeros(len(cells) + 1, dtype=np.int64)
+    np.cumsum([len(c) for c in cells], out=offsets[1:])
+    if cells:
+        cells = np.concatenate(cells)
+    else:
+        cells = np.empty(0, dtype=np.int64)
+    return Zones(cells, offsets, outside)
+
+
+def crop_zones(zones, shape):
+    """Return the window of the grid covering every zone and the zones in it.
+
+    The window is a (rows, cols) pair of slices; the cells of the returned
+    zones index the flattened window instead of the whole grid.
+    """
+    if len(zones.cells) == 0:
+        return (slice(0, 0), slice(0, 0)), zones
+    rows, cols = np.divmod(zones.cells, shape[1])
+    row_start, row_stop = rows.min(), rows.max() + 1
+    col_start, col_stop = cols.min(), cols.max() + 1
+    cells = (rows - row_start) * (col_stop - col_start) + (cols - col_start)
+    window = (slice(int(row_start), int(row_stop)),
+              slice(int(col_start), int(col_stop)))
+    return window, zones._replace(cells=cells)
+
+
+def zonal_statistics(values, zones, stats, nodata=None, dtype=np.float32):
+    """Return each statistic per zone, or per (time, zone) for a stack."""
+    stats = check_statistics(stats)
+    values = np.asarray(values)
+    n_grids = values.shape[0] if values.ndim == 3 else 1
+    results = _zone_statistics(values.reshape(n_grids, -1 if n_grids else 0),
+                               zones, stats, nodata, dtype)
+    if values.ndim != 3:
+        return results
+    n_zones = len(zones.offsets) - 1
+    return {s: r.reshape(n_grids, n_zones) for s, r in results.items()}
+
+
+def _zone_statistics(grids, zones, stats, nodata, dtype):
+    """Reduce every zone of every flattened grid, grid by grid."""
+    percentiles = [s for s in stats if s.startswith('percentile_')]
+    quantiles = np.array([50.0] + [get_percentile(p) for p in percentiles],
+                         dtype=np.float64)
+    kernel = _zonal_kernel(
+        extremes=bool({'min', 'max', 'range'} & set(stats)),
+        moments=bool({'mean', 'sum', 'std'} & set(stats)),
+        spread='std' in stats,
+        sort='median' in stats or bool(percentiles),
+        runs=bool({'majority', 'minority', 'unique'} & set(stats)))
+    (count, total, mean, minimum, maximum, std, quantile_values, majority,
+     minority, unique, nodata_count, nan_count) = kernel(
+        grids, _blank_grids(grids, nodata), zones.cells, zones.offsets,
+        0.0 if nodata is None else nodata, nodata is not None, quantiles)
+    nodata_count += np.tile(zones.outside, len(grids))
+    results = {'min': minimum, 'max': maximum, 'mean': mean,
+               'count': count, 'sum': total, 'std': std,
+               'median': quantile_values[:, 0], 'majority': majority,
+               'minority': minority, 'unique': unique,
+               'range': maximum - minimum, 'nodata': nodata_count,
+               'nan': nan_count}
+    for i, p in enumerate(percentiles):
+        results[p] = quantile_values[:, i + 1]
+    order = STATS_ORDER + percentiles + ['nodata', 'nan']
+    return {s: results[s] if s == 'count' else
+            results[s].astype(dtype, copy=False)
+            for s in order if s in stats}
+
+
+def _blank_grids(grids, nodata, stride=1024):
+    """Flag grids holding only NaN (1) or only nodata (2), 0 for the rest.
+
+    A strided sample rejects grids with valid values before any full scan,
+    so only (nearly) empty grids are compared cell by cell.
+    """
+    blanks = np.zeros(len(grids), dtype=np.int8)
+    for g, grid in enumerate(grids):
+        sample = grid[::stride]
+        if np.isnan(sample).all():
+            if np.isnan(grid).all():
+                blanks[g] = 1
+        elif nodata is not None and (sample == nodata).all():
+            if (grid == nodata).all():
+                blanks[g] = 2
+    return blanks
+
+
+@lru_cache(maxsize=None)
+def _zonal_kernel(extremes, moments, spread, sort, runs):
+    """Return the zonal kernel specialized for the wanted statistics.
+
+    The flags are closed over, so numba compiles them as constants and
+    prunes the work of statistics that are not asked for: extremes (min,
+    max, range), moments (sum, mean), spread (std), sort (median,
+    percentiles) and runs (majority, minority, unique). Each combination is
+    compiled once and kept in numba's on-disk cache.
+    """
+    moments = moments or spread
+
+    @njit(parallel=True, nogil=True, cache=True)
+    def kernel(grids, blanks, cells, offsets, nodata, has_nodata, quantiles):
+        """Sweep every (grid, zone) pair once, spreading pairs over threads.
+
+        Each pair reads its cells straight from the grid, so there is no
+        serial gather of the zone values beforehand. The valid values of a
+        pair are only copied out and sorted for the order statistics. Pairs of
+        blank grids only have their NaN or nodata cells counted.
+        """
+        n_zones = len(offsets) - 1
+        n_segments = len(grids) * n_zones
+        count = np.zeros(n_segments, dtype=np.int64)
+        total = np.full(n_segments, np.nan, dtype=np.float64)
+        mean = np.full(n_segments, np.nan, dtype=np.float64)
+        minimum = np.full(n_segments, np.nan, dtype=np.float64)
+        maximum = np.full(n_segments, np.nan, dtype=np.float64)
+        std = np.full(n_segments, np.nan, dtype=np.float64)
+        quantile_values = np.full((n_segments, len(quantiles)), np.nan,
+                                  dtype=np.float64)
+        majority = np.full(n_segments, np.nan, dtype=np.float64)
+        minority = np.full(n_segments, np.nan, dtype=np.float64)
+        unique = np.full(n_segments, np.nan, dtype=np.float64)
+        nodata_count = np.zeros(n_segments, dtype=np.int64)
+        nan_count = np.zeros(n_segments, dtype=np.int64)
+        for i in prange(n_segments):
+            grid = grids[i // n_zones]
+            zone = i % n_zones
+            start, stop = offsets[zone], offsets[zone + 1]
+            if blanks[i // n_zones] == 1:
+                nan_count[i] = stop - start
+                continue
+            if blanks[i // n_zones] == 2:
+                nodata_count[i] = stop - start
+                continue
+            n = 0
+            seg_total = 0.0
+            seg_min = np.inf
+            seg_max = -np.inf
+            for j in range(start, stop):
+                v = grid[cells[j]]
+                if np.isnan(v):
+                    nan_count[i] += 1
+                elif has_nodata and v == nodata:
+                    nodata_count[i] += 1
+                else:
+                    n += 1
+                    if moments:
+                        seg_total += v
+                    if extremes:
+                        seg_min = min(seg_min, v)
+                        seg_max = max(seg_max, v)
+            count[i] = n
+            if n == 0:
+                continue
+            if moments:
+                total[i] = seg_total
+                mean[i] = seg_total / n
+            if extremes:
+                minimum[i] = seg_min
+                maximum[i] = seg_max
+            if spread:
+                # second pass over the deviations rather than a sum of squares
+                squares = 0.0
+                for j in range(start, stop):
+                    v = grid[cells[j]]
+                    if not (np.isnan(v) or (has_nodata and v == nodata)):
+                        squares += (v - mean[i]) * (v - mean[i])
+                std[i] = np.sqrt(squares / n)
+            if not (sort or runs):
+                continue
+            ordered = np.empty(n, dtype=grids.dtype)
+            k = 0
+            for j in range(start, stop):
+                v = grid[cells[j]]
+                if not (np.isnan(v) or (has_nodata and v == nodata)):
+                    ordered[k] = v
+                    k += 1
+            ordered.sort()
+            for q in range(len(quantiles)):
+                position = (n - 1) * quantiles[q] / 100.0
+                low = int(np.floor(position))
+                high = int(np.ceil(position))
+                quantile_values[i, q] = ordered[low] + (
+                    ordered[high] - ordered[low]) * (position - low)
+            if not runs:
+                continue
+            # runs of equal values come in ascending order, so strict
+            # comparisons settle ties on the lowest value as rasterstats does
+            n_unique = 0
+            most = 0
+            least = n + 1
+            run_start = 0
+            for j in range(1, n + 1):
+                if j == n or ordered[j] != ordered[run_start]:
+                    length = j - run_start
+                    n_unique += 1
+                    if length > most:
+                        most = length
+                        majority[i] = ordered[run_start]
+                    if length < least:
+                        least = length
+                        minority[i] = ordered[run_start]
+                    run_start = j
+            unique[i] = n_unique
+        return (count, total, mean, minimum, maximum, std, quantile_values,
+                majority, minority, unique, nodata_count, nan_count)
+
+    return kernel